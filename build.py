@@ -1,21 +1,67 @@
 from pathlib import Path
+import argparse
+import functools
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import re
 import shutil
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
+from operator import attrgetter
 import markdown
 import yaml
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    Template,
+    select_autoescape,
+)
+from markupsafe import Markup
+
+try:
+    from yaml import CSafeLoader as _YAMLLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as _YAMLLoader
+
+try:
+    import mistune
+except ImportError:  # only needed for HECKLA_MD_ENGINE=mistune
+    mistune = None
+
+try:
+    import brotli
+except ImportError:  # HECKLA_PRECOMPRESS then writes .gz only
+    brotli = None
 
 
 # --------------------------------------------------------------------
 # Paths
 # --------------------------------------------------------------------
 
+# Default site root: the repo heckla/ is checked out into
 SITE_ROOT = Path(__file__).resolve().parent.parent
 
-CONTENT_DIR   = SITE_ROOT / "content"
-TEMPLATES_DIR = SITE_ROOT / "templates"
-STATIC_DIR    = SITE_ROOT / "static"
-DIST_DIR      = SITE_ROOT / "dist"
+
+# --------------------------------------------------------------------
+# Settings
+# --------------------------------------------------------------------
+
+# "markdown" (Python-Markdown) or "mistune". mistune has no equivalent
+# of the "extra" extension (abbr, attr_list, md_in_html, ...)
+MD_ENGINE = os.environ.get("HECKLA_MD_ENGINE", "markdown")
+MD_ENGINES = ("markdown", "mistune")
+
+# Also write index.html.gz (and .br, if brotli is installed) per page
+PRECOMPRESS = os.environ.get("HECKLA_PRECOMPRESS", "") not in ("", "0")
+
+# Bump whenever parse_markdown output changes for the same source
+PARSE_CACHE_VERSION = 5
 
 
 # --------------------------------------------------------------------
@@ -30,181 +76,555 @@ class Page:
     title: str
     description: str
     content_html: str
-    section: Path
+    section: str  # POSIX path under content/, "." for the root
 
 
 # --------------------------------------------------------------------
-# Setup
+# State
 # --------------------------------------------------------------------
 
-# Clean output directory
-if DIST_DIR.exists():
-    shutil.rmtree(DIST_DIR)
-DIST_DIR.mkdir()
-
-# Copy static files verbatim
-if STATIC_DIR.exists():
-    shutil.copytree(
-        STATIC_DIR,
-        DIST_DIR,
-        dirs_exist_ok=True
-    )
-
-# Jinja environment
-env = Environment(
-    loader=FileSystemLoader(TEMPLATES_DIR),
-    autoescape=select_autoescape(["html"])
+# Synthetic section index body; autoescaped like every other template
+INDEX_TEMPLATE = (
+    "\n<h1>{{ heading }}</h1>\n<ul>\n"
+    "{% for p in items %}"
+    '<li><a href="{{ p.url }}">{{ p.title }}</a></li>\n'
+    "{% endfor %}"
+    "</ul>\n"
 )
-template = env.get_template("default.html")
 
-# Markdown renderer
-md = markdown.Markdown(
-    extensions=["extra", "tables", "fenced_code"]
-)
+# Markdown renderers are stateful, so each thread gets its own (see _md)
+_tls = threading.local()
 
 
 # --------------------------------------------------------------------
 # Helpers
 # --------------------------------------------------------------------
 
-def parse_markdown(path: Path):
-    raw = path.read_text(encoding="utf-8")
+def _md():
+    if not hasattr(_tls, "md"):
+        if MD_ENGINE == "mistune":
+            # escape=False passes raw HTML through, as Python-Markdown does
+            _tls.md = mistune.create_markdown(
+                escape=False,
+                plugins=["table", "strikethrough", "footnotes", "def_list"],
+            )
+        else:
+            _tls.md = markdown.Markdown(
+                extensions=["extra", "tables", "fenced_code"]
+            )
 
-    frontmatter = {}
-    body = raw
+    return _tls.md
 
-    if raw.lstrip().startswith("---"):
-        parts = raw.split("---", 2)
-        if len(parts) == 3:
-            _, fm, body = parts
-            frontmatter = yaml.safe_load(fm) or {}
 
-    html = md.convert(body)
-    md.reset()
+def _init_worker():
+    # Build the worker's renderer before the first page arrives
+    _md()
 
-    return frontmatter, html
 
+# Identical bodies (stubs, generated pages) convert once per worker
+@functools.lru_cache(maxsize=4096)
+def convert_markdown(body: str) -> str:
+    m = _md()
 
-def title_from_path(path: Path) -> str:
-    return path.stem.replace("-", " ").title()
+    if MD_ENGINE == "mistune":
+        return m(body)
 
+    html = m.convert(body)
+    m.reset()
+    return html
 
-def page_output_and_url(rel: Path):
-    """
-    Routing rules:
-    - content/_index.md           → /
-    - content/section/_index.md   → /section/
-    - content/section/page.md     → /section/page/
-    """
-    if rel == Path("_index.md"):
-        return DIST_DIR, "/"
 
-    if rel.name == "_index.md":
-        return DIST_DIR / rel.parent, f"/{rel.parent}/"
+_FIELD_RE = re.compile(r"^(title|description)[ \t]*:[ \t]*(.*?)\s*$", re.M)
 
-    out_dir = DIST_DIR / rel.with_suffix("")
-    return out_dir, f"/{rel.with_suffix('')}/"
+# Indented lines, list items, explicit/quoted keys and flow collections
+_COMPLEX_FM_RE = re.compile(r"^(?:[ \t]+\S|[ \t]*[-?\"'{\[])", re.M)
 
+_YAML_INDICATORS = frozenset("\"'[]{}&*!|>%@`#")
 
-# --------------------------------------------------------------------
-# Parse phase (NO WRITING)
-# --------------------------------------------------------------------
+# Same implicit typing rules as the loader: null, bools, ints, dates...
+_YAML_RESOLVER = yaml.resolver.Resolver()
+_YAML_STR_TAG = "tag:yaml.org,2002:str"
+
+
+def load_frontmatter(fm: str):
+    """
+    Only title and description are ever read, so flat `key: value`
+    blocks skip YAML entirely; anything fancier gets the real loader.
+    """
+    # JSON is a subset of YAML, and json.loads is far cheaper
+    if fm.lstrip().startswith("{"):
+        try:
+            return json.loads(fm) or {}
+        except ValueError:
+            return yaml.load(fm, Loader=_YAMLLoader) or {}
+
+    if not _COMPLEX_FM_RE.search(fm):
+        fields = {}
+
+        for key, value in _FIELD_RE.findall(fm):
+            # Empty (null), quoted, flow, block, tagged, commented...
+            # let YAML decide
+            if not value or value[0] in _YAML_INDICATORS:
+                break
+            if ": " in value or " #" in value:
+                break
+            # Anything YAML wouldn't load as a string, too
+            tag = _YAML_RESOLVER.resolve(yaml.ScalarNode, value, (True, False))
+            if tag != _YAML_STR_TAG:
+                break
+            fields[key] = value
+        else:
+            return fields
+
+    return yaml.load(fm, Loader=_YAMLLoader) or {}
+
+
+_LEADING_WS_RE = re.compile(rb"\s*")
+
+
+def parse_markdown(path: str):
+    """
+    Runs inside a parse worker process; returns only picklable data.
+    """
+    with open(path, "rb", buffering=1 << 16) as f:
+        raw = f.read()
+
+    # Decode straight out of the buffer: no stripped or split copies
+    view = memoryview(raw)
+    start = _LEADING_WS_RE.match(raw).end()
+
+    if raw.startswith(b"---", start):
+        end = raw.find(b"\n---", start + 3)
+        if end != -1:
+            frontmatter = load_frontmatter(str(view[start + 3:end], "utf-8"))
+            body = str(view[end + 4:], "utf-8")
+            return frontmatter, convert_markdown(body)
+
+    return {}, convert_markdown(raw.decode("utf-8"))
+
+
+def _render_cached(
+    rendered: dict,
+    template: Template,
+    title: str,
+    description: str,
+    content: str,
+) -> str:
+    key = (
+        title,
+        description,
+        hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest(),
+    )
+
+    html = rendered.get(key)
+    if html is None:
+        html = rendered[key] = template.render(
+            title=title,
+            description=description,
+            content=content,
+        )
+
+    return html
 
-pages: list[Page] = []
-sections: dict[Path, list[Page]] = {}
 
-for md_path in CONTENT_DIR.rglob("*.md"):
-    rel = md_path.relative_to(CONTENT_DIR)
-    section = rel.parent
+def _parse_cache_version():
+    # Library upgrades can change the output for unchanged sources too
+    engine = mistune if MD_ENGINE == "mistune" else markdown
+    return PARSE_CACHE_VERSION, MD_ENGINE, engine.__version__, yaml.__version__
 
-    frontmatter, content_html = parse_markdown(md_path)
-    output_dir, url = page_output_and_url(rel)
 
-    page = Page(
-        source=md_path,
-        output_dir=output_dir,
-        url=url,
-        title=frontmatter.get("title", title_from_path(md_path)),
-        description=frontmatter.get("description", ""),
-        content_html=content_html,
-        section=section,
+def load_parse_cache(path: Path) -> dict:
+    """
+    Parsed pages from the previous build, keyed by path under content/:
+    {"mtime": ns, "size": bytes, "frontmatter": {...}, "html": "..."}
+    """
+    try:
+        with open(path, "rb") as f:
+            version, entries = pickle.load(f)
+    except (OSError, EOFError, TypeError, ValueError, pickle.UnpicklingError):
+        return {}
+
+    return entries if version == _parse_cache_version() else {}
+
+
+def save_parse_cache(path: Path, entries: dict):
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        pickle.dump(
+            (_parse_cache_version(), entries),
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    os.replace(tmp, path)
+
+
+def _cache_get(cache: dict, rel: str, st: os.stat_result):
+    entry = cache.get(rel)
+
+    if (
+        entry is not None
+        and entry["mtime"] == st.st_mtime_ns
+        and entry["size"] == st.st_size
+    ):
+        return entry
+
+    return None
+
+
+def write_html(output_dir: Path, html: str):
+    # One encode, one buffered write per file; output_dir must exist
+    data = html.encode("utf-8")
+    outputs = [("index.html", data)]
+
+    if PRECOMPRESS:
+        # mtime=0 keeps .gz output identical between builds
+        outputs.append(
+            ("index.html.gz", gzip.compress(data, compresslevel=6, mtime=0))
+        )
+        if brotli is not None:
+            outputs.append(("index.html.br", brotli.compress(data, quality=5)))
+
+    for name, payload in outputs:
+        with open(output_dir / name, "wb", buffering=1 << 20) as f:
+            f.write(payload)
+
+
+def emit_page(
+    rendered: dict,
+    template: Template,
+    output_dir: Path,
+    title: str,
+    description: str,
+    content: str,
+):
+    """
+    Runs on an emit thread; compiled Jinja templates are safe to share.
+    """
+    write_html(
+        output_dir,
+        _render_cached(rendered, template, title, description, content),
     )
 
-    pages.append(page)
-    sections.setdefault(section, []).append(page)
 
+def remove_trees(paths: list[Path]):
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
 
-# --------------------------------------------------------------------
-# Emit real pages
-# --------------------------------------------------------------------
 
-for page in pages:
-    page.output_dir.mkdir(parents=True, exist_ok=True)
+def _iter_md(root: Path):
+    """
+    Yields (path, rel, stat) for every .md file under root, where rel is
+    the POSIX path relative to root. Symlinked directories are skipped.
+    """
+    stack = [(os.fspath(root), "")]
+
+    while stack:
+        directory, prefix = stack.pop()
 
-    html = template.render(
-        title=page.title,
-        description=page.description,
-        content=page.content_html,
-    )
+        with os.scandir(directory) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    stack.append((e.path, f"{prefix}{e.name}/"))
+                elif e.name.endswith(".md"):
+                    yield e.path, prefix + e.name, e.stat()
 
-    (page.output_dir / "index.html").write_text(html, encoding="utf-8")
-    print(f"Built {page.url}")
 
+_WORD_SEPARATORS = str.maketrans("-_", "  ")
 
-# --------------------------------------------------------------------
-# Emit synthetic section indexes
-# --------------------------------------------------------------------
 
-for section, section_pages in sections.items():
+def _humanize(name: str) -> str:
+    """
+    Fallback title for a page file stem or section directory name:
+    "my-first_post" → "My First Post"
+    """
+    return " ".join(
+        w.capitalize() for w in name.translate(_WORD_SEPARATORS).split()
+    )
 
-    # Root handled explicitly via content/_index.md
-    if section == Path("."):
-        continue
 
-    index_md = CONTENT_DIR / section / "_index.md"
+def page_output_and_url(rel: str, dist_dir: Path):
+    """
+    Routing rules (rel is a POSIX path relative to content/):
+    - content/_index.md           → /
+    - content/section/_index.md   → /section/
+    - content/section/page.md     → /section/page/
+    """
+    if rel == "_index.md":
+        return dist_dir, "/"
 
-    # Real index exists → already rendered
-    if index_md.exists():
-        continue
+    if rel.endswith("/_index.md"):
+        section = rel[:-len("/_index.md")]
+        return dist_dir / section, f"/{section}/"
 
-    # Only include non-index pages
-    children = [
-        p for p in section_pages
-        if p.source.name != "_index.md"
-    ]
+    stem = rel[:-len(".md")]
+    return dist_dir / stem, f"/{stem}/"
 
-    if not children:
-        continue
 
-    heading = section.name.replace("-", " ").title()
+def main(site_root: Path = SITE_ROOT, output: Path | None = None):
+    if MD_ENGINE not in MD_ENGINES:
+        raise SystemExit(
+            f"Unknown HECKLA_MD_ENGINE {MD_ENGINE!r}, "
+            f"expected one of {', '.join(MD_ENGINES)}"
+        )
 
-    list_items = "\n".join(
-        f'<li><a href="{p.url}">{p.title}</a></li>'
-        for p in sorted(children, key=lambda p: p.title)
-    )
+    if MD_ENGINE == "mistune" and mistune is None:
+        raise SystemExit("HECKLA_MD_ENGINE=mistune requires `pip install mistune`")
 
-    synthetic_content = f"""
-<h1>{heading}</h1>
-<ul>
-{list_items}
-</ul>
-"""
+    content_dir   = site_root / "content"
+    templates_dir = site_root / "templates"
+    static_dir    = site_root / "static"
+    dist_dir      = output or site_root / "dist"
+    cache_dir     = site_root / ".heckla_cache"
 
-    output_dir = DIST_DIR / section
-    output_dir.mkdir(parents=True, exist_ok=True)
 
-    html = template.render(
-        title=heading,
-        description=f"Index of {heading}",
-        content=synthetic_content,
-    )
+    # --------------------------------------------------------------------
+    # Setup
+    # --------------------------------------------------------------------
 
-    (output_dir / "index.html").write_text(html, encoding="utf-8")
-    print(f"Generated synthetic index for /{section}/")
+    # Jinja environment; compiled templates persist between builds
+    (cache_dir / "jinja").mkdir(parents=True, exist_ok=True)
 
+    env = Environment(
+        loader=FileSystemLoader(templates_dir),
+        autoescape=select_autoescape(["html"]),
+        bytecode_cache=FileSystemBytecodeCache(directory=cache_dir / "jinja"),
+    )
+    template = env.get_template("default.html")
+    index_template = env.from_string(INDEX_TEMPLATE)
+
+
+    # Clean output directory. The old build is moved aside as
+    # <dist>.heckla-old-<pid> and deleted in the background rather than
+    # blocking on rmtree. Leftovers from builds that were killed before
+    # cleaning up go with it; nothing else matches that exact shape.
+    stale_prefix = f"{dist_dir.name}.heckla-old-"
+    stale_dists = sorted(
+        p for p in dist_dir.parent.glob("*.heckla-old-*")
+        if p.name.startswith(stale_prefix)
+        and p.name[len(stale_prefix):].isdigit()
+    )
 
-# --------------------------------------------------------------------
-# Done
-# --------------------------------------------------------------------
+    if dist_dir.exists():
+        stale_dist = dist_dir.with_name(f"{stale_prefix}{os.getpid()}")
+        try:
+            dist_dir.rename(stale_dist)
+            stale_dists.append(stale_dist)
+        except OSError:  # e.g. dist/ is a mount point
+            shutil.rmtree(dist_dir)
+
+    try:
+        dist_dir.mkdir(parents=True)
+
+        # Copy static files verbatim
+        if static_dir.exists():
+            shutil.copytree(
+                static_dir,
+                dist_dir,
+                dirs_exist_ok=True
+            )
+
+
+        # ----------------------------------------------------------------
+        # Parse phase (NO WRITING)
+        # ----------------------------------------------------------------
+
+        pages: list[Page] = []
+        sections: dict[str, list[Page]] = defaultdict(list)
+
+        sources = list(_iter_md(content_dir))
+
+        # Unchanged files (same mtime + size) reuse last build's parse;
+        # only the rest go to parse_markdown
+        cache = load_parse_cache(cache_dir / "index.pkl")
+        entries: dict[str, dict] = {}
+        misses: list[tuple[str, str]] = []
+
+        for path, rel, st in sources:
+            entry = _cache_get(cache, rel, st)
+
+            if entry is None:
+                entry = {"mtime": st.st_mtime_ns, "size": st.st_size}
+                misses.append((path, rel))
+
+            entries[rel] = entry
+
+        if misses:
+            # Markdown + YAML are pure Python, so parse in worker processes
+            # to get past the GIL. Rendering stays here: templates don't
+            # pickle.
+            chunksize = max(1, len(misses) // (4 * (os.cpu_count() or 1)))
+
+            with ProcessPoolExecutor(initializer=_init_worker) as ex:
+                results = ex.map(
+                    parse_markdown,
+                    [path for path, _ in misses],
+                    chunksize=chunksize,
+                )
+
+                for (_, rel), parsed in zip(misses, results):
+                    entry = entries[rel]
+                    entry["frontmatter"], entry["html"] = parsed
+
+        # Rewritten from scratch so deleted sources drop out
+        save_parse_cache(cache_dir / "index.pkl", entries)
+
+        # Pages are written concurrently, so two sources routing to one
+        # index.html would race; e.g. docs.md and docs/_index.md
+        routes: dict[Path, str] = {}
+
+        for path, rel, _ in sources:
+            md_path = Path(path)
+            entry = entries[rel]
+            frontmatter = entry["frontmatter"]
+            content_html = entry["html"]
+
+            section = rel.rpartition("/")[0] or "."
+
+            output_dir, url = page_output_and_url(rel, dist_dir)
+
+            if output_dir in routes:
+                first, second = sorted((routes[output_dir], rel))
+                raise SystemExit(
+                    f"Route collision: content/{first} and "
+                    f"content/{second} both build {url}"
+                )
+            routes[output_dir] = rel
+
+            page = Page(
+                source=md_path,
+                output_dir=output_dir,
+                url=url,
+                title=frontmatter.get("title", _humanize(md_path.stem)),
+                description=frontmatter.get("description", ""),
+                content_html=content_html,
+                section=section,
+            )
+
+            pages.append(page)
+            sections[section].append(page)
+
+    finally:
+        # Started only once the parse pool is shut down, since forking
+        # workers while a thread runs is unsafe; runs even if the build
+        # failed. Non-daemon, so the interpreter waits for it on exit.
+        if stale_dists:
+            threading.Thread(
+                target=remove_trees,
+                args=(stale_dists,),
+            ).start()
+
+
+    # --------------------------------------------------------------------
+    # Emit real pages
+    # --------------------------------------------------------------------
+
+    # Each output directory is created once, up front. Synthetic section
+    # indexes land in a parent of their children's directories, so this
+    # covers them as well.
+    for output_dir in {page.output_dir for page in pages}:
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Rendered HTML keyed by (title, description, content digest), so
+    # pages with identical context render once; dropped with the build
+    rendered: dict[tuple[str, str, bytes], str] = {}
+
+    # Writes release the GIL, so threads overlap IO with rendering
+    emit_workers = min(32, (os.cpu_count() or 1) * 4)
+
+    with ThreadPoolExecutor(max_workers=emit_workers) as ex:
+        jobs = [
+            (page, ex.submit(
+                emit_page,
+                rendered,
+                template,
+                page.output_dir,
+                page.title,
+                page.description,
+                page.content_html,
+            ))
+            for page in pages
+        ]
+
+        for page, job in jobs:
+            job.result()
+            print(f"Built {page.url}")
+
+
+    # --------------------------------------------------------------------
+    # Emit synthetic section indexes
+    # --------------------------------------------------------------------
+
+    with ThreadPoolExecutor(max_workers=emit_workers) as ex:
+        jobs = []
+
+        for section, section_pages in sections.items():
+
+            # Root handled explicitly via content/_index.md
+            if section == ".":
+                continue
+
+            index_md = content_dir / section / "_index.md"
+
+            # Real index exists → already rendered
+            if index_md.exists():
+                continue
+
+            # Only include non-index pages
+            children = [
+                p for p in section_pages
+                if p.source.name != "_index.md"
+            ]
+
+            if not children:
+                continue
+
+            heading = _humanize(section.rpartition("/")[2])
+
+            # Already escaped, so the page template must not escape it again
+            synthetic_content = Markup(index_template.render(
+                heading=heading,
+                items=sorted(children, key=attrgetter("title")),
+            ))
+
+            jobs.append((section, ex.submit(
+                emit_page,
+                rendered,
+                template,
+                dist_dir / section,
+                heading,
+                f"Index of {heading}",
+                synthetic_content,
+            )))
+
+        for section, job in jobs:
+            job.result()
+            print(f"Generated synthetic index for /{section}/")
+
+
+    # --------------------------------------------------------------------
+    # Done
+    # --------------------------------------------------------------------
+
+    print("Build complete.")
+
+
+# Worker processes re-import this module under spawn/forkserver, so the
+# build itself must only run from the entrypoint.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a heckla site.")
+    parser.add_argument(
+        "site_root",
+        nargs="?",
+        type=Path,
+        default=SITE_ROOT,
+        help="directory holding content/, templates/ and static/ "
+             "(default: the parent of heckla/)",
+    )
+    parser.add_argument(
+        "-o", "--output",
+        type=Path,
+        help="output directory (default: SITE_ROOT/dist)",
+    )
+    args = parser.parse_args()
 
-print("Build complete.")
+    main(args.site_root.resolve(), args.output and args.output.resolve())